@@ -3,6 +3,7 @@ MBP University — Main Streamlit Application
 """
 
 import os
+import hashlib
 import logging
 import streamlit as st
 import anthropic
@@ -14,11 +15,16 @@ from config import (
     SYSTEM_PROMPT,
     CLAUDE_MODEL,
     MAX_TOKENS,
+    HISTORY_MAX_MESSAGES,
+    HISTORY_ASSISTANT_MAX_CHARS,
+    HISTORY_MAX_CHARS,
     EMBEDDING_MODEL,
     EMBEDDING_DIMENSION,
+    EMBEDDING_ONNX_FILE,
+    CPU_THREADS,
     DOCUMENTS_DIR,
 )
-from ingest import ingest_all, build_vector_store
+from ingest import ingest_all, build_vector_store, index_cache_key
 from retriever import search, format_context, format_sources_for_display
 
 # ── Logging (visible in Streamlit Cloud → Manage app → Logs) ────────────
@@ -166,9 +172,20 @@ st.markdown(
 
 @st.cache_resource(show_spinner="Loading embedding model …")
 def get_embedding_model():
+    import onnxruntime as ort
     from sentence_transformers import SentenceTransformer
     logger.info("Loading SentenceTransformer model …")
-    model = SentenceTransformer(EMBEDDING_MODEL)
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = CPU_THREADS
+    model = SentenceTransformer(
+        EMBEDDING_MODEL,
+        backend="onnx",
+        model_kwargs={
+            "file_name": EMBEDDING_ONNX_FILE,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
     logger.info("Embedding model loaded.")
     return model
 
@@ -186,26 +203,39 @@ def build_index(_embed_model):
         parent = os.path.dirname(DOCUMENTS_DIR)
         if os.path.isdir(parent):
             logger.error(f"  parent dir ({parent}) contains: {os.listdir(parent)}")
-        return None, [], []
+        return None, [], [], None
 
     try:
         chunks, filenames = ingest_all(DOCUMENTS_DIR)
     except Exception as e:
         logger.error(f"Ingestion crashed: {e}", exc_info=True)
-        return None, [], []
+        return None, [], [], None
 
     if not chunks:
         logger.warning("Ingestion returned 0 chunks.")
-        return None, [], filenames
+        return None, [], filenames, None
 
     try:
         index = build_vector_store(chunks, _embed_model)
     except Exception as e:
         logger.error(f"Embedding/FAISS crashed: {e}", exc_info=True)
-        return None, [], filenames
+        return None, [], filenames, None
 
     logger.info(f"Index ready: {index.ntotal} vectors from {filenames}")
-    return index, chunks, filenames
+    # Stable identity of this index + its metadata, used to key cached_search
+    corpus_key = (
+        index_cache_key([c["text"] for c in chunks]),
+        hashlib.sha256(repr(chunks).encode()).hexdigest(),
+    )
+    return index, chunks, filenames, corpus_key
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def cached_search(prompt: str, corpus_key: tuple, _index, _metadata, _embed_model) -> list[dict]:
+    # Keyed on (prompt, corpus_key); underscored args are skipped by Streamlit's hasher.
+    # corpus_key hashes the chunk texts + embedding/index settings and the full
+    # chunk metadata, so unlike id(index) it can't collide across rebuilds.
+    return search(prompt, _index, _metadata, _embed_model)
 
 
 def get_anthropic_client():
@@ -226,6 +256,31 @@ def _pretty_filename(fn: str) -> tuple[str, str]:
         return "📄", fn.replace("_", " ").replace("-", " ").rsplit(".", 1)[0]
 
 
+def _trim_history(messages: list[dict]) -> list[dict]:
+    """
+    Prior turns to send to Claude, trimmed to keep prefill tokens down:
+    assistant turns are truncated and the total is capped.  User turns are
+    stored as the raw prompt (retrieved context is only sent for the
+    current turn), so they are passed through as-is.
+    """
+    trimmed: list[dict] = []
+    total = 0
+    for m in reversed(messages[-HISTORY_MAX_MESSAGES:]):
+        content = m["content"]
+        if m["role"] == "assistant" and len(content) > HISTORY_ASSISTANT_MAX_CHARS:
+            content = content[:HISTORY_ASSISTANT_MAX_CHARS] + " …"
+        if total + len(content) > HISTORY_MAX_CHARS:
+            break
+        total += len(content)
+        trimmed.append({"role": m["role"], "content": content})
+    trimmed.reverse()
+
+    # The conversation sent to Claude should open with a user turn
+    while trimmed and trimmed[0]["role"] != "user":
+        trimmed.pop(0)
+    return trimmed
+
+
 # ────────────────────────────────────────────────────────────────────────
 # Sidebar
 # ────────────────────────────────────────────────────────────────────────
@@ -249,7 +304,7 @@ with st.sidebar:
 
     # Load model & index
     embed_model = get_embedding_model()
-    index, metadata, doc_filenames = build_index(embed_model)
+    index, metadata, doc_filenames, corpus_key = build_index(embed_model)
 
     if doc_filenames:
         st.markdown("**📚 Loaded Sources**")
@@ -320,13 +375,10 @@ if prompt := st.chat_input("Ask MBP University a question …"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    results = search(prompt, index, metadata, embed_model)
+    results = cached_search(prompt, corpus_key, index, metadata, embed_model)
     context_block = format_context(results)
-    sources_display = format_sources_for_display(results)
 
-    claude_messages: list[dict] = []
-    for m in st.session_state.messages[-11:-1]:
-        claude_messages.append({"role": m["role"], "content": m["content"]})
+    claude_messages = _trim_history(st.session_state.messages[:-1])
 
     user_content = (
         f"## Retrieved Document Context\n\n{context_block}\n\n---\n\n"
@@ -351,6 +403,8 @@ if prompt := st.chat_input("Ask MBP University a question …"):
 
             placeholder.markdown(full_response)
 
+            # Built only after streaming so it stays off the time-to-first-token path
+            sources_display = format_sources_for_display(results)
             with st.expander("📄 View Sources"):
                 st.markdown(sources_display)
 
@@ -7,22 +7,48 @@ import os
 # ── Paths (resolved relative to THIS file so it works on Streamlit Cloud) ─
 _APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DOCUMENTS_DIR = os.path.join(_APP_DIR, "documents")
+# Persisted FAISS index, keyed by a hash of the chunk texts + embedding settings
+INDEX_CACHE_DIR = os.path.join(DOCUMENTS_DIR, ".cache")
 
 # ── Chunking ────────────────────────────────────────────────────────────
 CHUNK_MAX_TOKENS = 1000
 CHUNK_OVERLAP_TOKENS = 100
+# Parse .docx files in worker processes only from this many files up; below
+# it, starting the pool costs more than parsing serially.
+PARALLEL_PARSE_MIN_DOCX = 4
+
+# ── Threads ─────────────────────────────────────────────────────────────
+# Shared by ONNX Runtime and FAISS.  Capped because os.cpu_count() reports
+# the host's cores inside a container, not its CPU quota, and the runners are small.
+CPU_THREADS = min(os.cpu_count() or 2, 4)
 
 # ── Retrieval ───────────────────────────────────────────────────────────
 TOP_K = 5
 
+# ── Vector index ────────────────────────────────────────────────────────
+# Below this many chunks an exact flat scan is cheaper than building HNSW
+HNSW_MIN_VECTORS = 500
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+
 # ── Embedding model (HuggingFace — free, no API key needed) ────────────
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 EMBEDDING_DIMENSION = 384
+# Prebuilt int8 ONNX weights shipped with the model on the Hub (VNNI-optimised),
+# loaded through sentence-transformers' ONNX backend
+EMBEDDING_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+EMBEDDING_BATCH_SIZE = 64
 
 # ── LLM ─────────────────────────────────────────────────────────────────
 CLAUDE_MODEL = "claude-sonnet-4-20250514"
 MAX_TOKENS = 2048
 
+# ── Chat history sent to Claude ─────────────────────────────────────────
+HISTORY_MAX_MESSAGES = 10          # prior messages (user + assistant), i.e. 5 turns
+HISTORY_ASSISTANT_MAX_CHARS = 400   # per prior assistant message
+HISTORY_MAX_CHARS = 6000            # total across all prior messages
+
 # ── UI ──────────────────────────────────────────────────────────────────
 APP_TITLE = "🎓 MBP University"
 APP_DESCRIPTION = (
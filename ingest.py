@@ -2,32 +2,57 @@
 MBP University — Document Ingestion & Embedding Pipeline
 
 Parses .docx SOP files and .xlsx FAQ files, chunks them, embeds them,
-and returns an in-memory FAISS index.  Nothing is written to disk —
-the index lives in RAM and is cached by Streamlit's @st.cache_resource.
+and returns an in-memory FAISS index.  Within a live container the result
+is cached by Streamlit's @st.cache_resource.  The FAISS index is also
+written to documents/.cache/, keyed by a hash of the chunk texts and the
+embedding/index settings.  Parsing always runs, but the embedding pass is
+skipped on a cache hit — which only happens when the filesystem survives
+the restart.  documents/.cache/ is gitignored, so a fresh clone (e.g. a new
+Streamlit Cloud container) always re-embeds.
 """
 
+from __future__ import annotations
+
 import os
 import re
+import hashlib
+import contextlib
 import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
-import faiss
 import numpy as np
-import openpyxl
-from docx import Document
-from sentence_transformers import SentenceTransformer
+
+# faiss, openpyxl, python-docx and sentence-transformers (which pulls in
+# PyTorch) are imported inside the functions that use them so importing
+# this module stays cheap and Streamlit can paint before they load.
+if TYPE_CHECKING:
+    import faiss
+    from sentence_transformers import SentenceTransformer
 
 from config import (
     DOCUMENTS_DIR,
+    INDEX_CACHE_DIR,
     EMBEDDING_MODEL,
     EMBEDDING_DIMENSION,
+    EMBEDDING_ONNX_FILE,
+    EMBEDDING_BATCH_SIZE,
     CHUNK_MAX_TOKENS,
     CHUNK_OVERLAP_TOKENS,
+    PARALLEL_PARSE_MIN_DOCX,
+    HNSW_MIN_VECTORS,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    CPU_THREADS,
 )
 
 logger = logging.getLogger(__name__)
 
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+
 
 # ────────────────────────────────────────────────────────────────────────
 # Helpers
@@ -38,6 +63,15 @@ def _approx_token_count(text: str) -> int:
     return int(len(text.split()) * 1.3)
 
 
+_GENERIC_LABELS = frozenset({
+    "steps", "purpose", "owner", "timing", "when applicable",
+    "contact history", "cs attempts", "collection attempts",
+    "requested assistance", "common triggers", "summary of call",
+    "accounting impact", "interest application",
+})
+_DIALOGUE_MARKERS = ("hi [", "this is [", "thank you", "calling from")
+
+
 def _is_section_heading(paragraph) -> bool:
     """
     Detect SOP section headings: bold text that looks like a title.
@@ -47,41 +81,38 @@ def _is_section_heading(paragraph) -> bool:
     if not text or len(text) > 120:
         return False
 
-    runs_with_text = [r for r in paragraph.runs if r.text.strip()]
-    if not runs_with_text:
-        return False
-
-    all_bold = all(r.bold for r in runs_with_text)
-    if not all_bold:
+    # Every run with text must be bold; bail on the first one that isn't
+    any_text = False
+    for r in paragraph.runs:
+        t = r.text
+        if not t or not t.strip():
+            continue
+        if not r.bold:
+            return False
+        any_text = True
+    if not any_text:
         return False
 
     # ── Skip generic one-word / role labels ─────────────────────────────
-    clean = text.rstrip(":- ")
-    _GENERIC_LABELS = {
-        "steps", "purpose", "owner", "timing", "when applicable",
-        "contact history", "cs attempts", "collection attempts",
-        "requested assistance", "common triggers", "summary of call",
-        "accounting impact", "interest application",
-    }
-    if clean.lower() in _GENERIC_LABELS:
-        return False
-    if clean.lower().startswith("owner:"):
+    text_lower = text.lower()
+    clean_lower = text_lower.rstrip(":- ")
+    if clean_lower in _GENERIC_LABELS:
         return False
-    if clean.lower().startswith("timing:"):
+    if clean_lower.startswith(("owner:", "timing:")):
         return False
 
     # Skip lines that look like dialogue / email templates
-    if any(p in text.lower() for p in ["hi [", "this is [", "thank you", "calling from"]):
+    if any(p in text_lower for p in _DIALOGUE_MARKERS):
         return False
 
     # ── Positive signals ────────────────────────────────────────────────
     # Mostly-uppercase titles like "PURPOSE", "SCOPE"
-    upper_ratio = sum(1 for c in text if c.isupper()) / max(len(text.replace(" ", "")), 1)
+    upper_ratio = sum(map(str.isupper, text)) / max(len(text) - text.count(" "), 1)
     if upper_ratio > 0.6:
         return True
 
     # Short bold multi-word text → likely a sub-heading
-    if len(text) < 80 and len(clean.split()) >= 2:
+    if len(text) < 80 and len(clean_lower.split()) >= 2:
         return True
 
     return False
@@ -107,6 +138,9 @@ def parse_docx(filepath: str) -> list[dict]:
     Returns list of dicts:
         { "text", "section", "source", "type": "sop" }
     """
+    from docx import Document
+    from docx.oxml.ns import qn
+
     doc = Document(filepath)
     filename = os.path.basename(filepath)
     sections: list[dict] = []
@@ -123,30 +157,43 @@ def parse_docx(filepath: str) -> list[dict]:
                 "type": "sop",
             })
 
-    # Walk body XML to interleave paragraphs and tables in document order
-    from docx.oxml.ns import qn
+    def _add_paragraph(p):
+        nonlocal current_section, current_text_parts
+        if _is_section_heading(p):
+            _flush()
+            current_section = p.text.strip()
+            current_text_parts = [f"## {current_section}"]
+        else:
+            text = p.text.strip()
+            if text:
+                current_text_parts.append(text)
 
-    body = doc.element.body
-    para_idx = 0
-    table_idx = 0
-    paragraphs = doc.paragraphs
     tables = doc.tables
-
-    for child in body:
-        if child.tag == qn("w:p"):
-            if para_idx < len(paragraphs):
-                p = paragraphs[para_idx]
-                para_idx += 1
-                if _is_section_heading(p):
-                    _flush()
-                    current_section = p.text.strip()
-                    current_text_parts = [f"## {current_section}"]
-                elif p.text.strip():
-                    current_text_parts.append(p.text.strip())
-        elif child.tag == qn("w:tbl"):
-            if table_idx < len(tables):
-                tbl_text = _extract_table_text(tables[table_idx])
-                table_idx += 1
+    if not tables:
+        # Fast path: doc.paragraphs is already in document order
+        for p in doc.paragraphs:
+            _add_paragraph(p)
+        _flush()
+        return sections
+
+    # Walk body XML to interleave paragraphs and tables in document order.
+    # Wrappers are looked up by element so no ordering assumption is needed;
+    # tags are resolved once since qn() does a namespace lookup per call.
+    w_p = qn("w:p")
+    w_tbl = qn("w:tbl")
+    para_map = {p._element: p for p in doc.paragraphs}
+    tbl_map = {t._element: t for t in tables}
+
+    for child in doc.element.body:
+        tag = child.tag
+        if tag == w_p:
+            p = para_map.get(child)
+            if p is not None:
+                _add_paragraph(p)
+        elif tag == w_tbl:
+            t = tbl_map.get(child)
+            if t is not None:
+                tbl_text = _extract_table_text(t)
                 if tbl_text.strip():
                     current_text_parts.append(tbl_text)
 
@@ -165,6 +212,8 @@ def parse_xlsx(filepath: str) -> list[dict]:
     Returns list of dicts with keys:
         text, source, type, topic, location, question, resource_link, section
     """
+    import openpyxl
+
     wb = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
     ws = wb.active
 
@@ -190,15 +239,26 @@ def parse_xlsx(filepath: str) -> list[dict]:
     chunks: list[dict] = []
     filename = os.path.basename(filepath)
 
+    # Resolve column positions once instead of per row
+    t_i = col_map.get("topic", 0)
+    l_i = col_map.get("location", 1)
+    q_i = col_map.get("question", 2)
+    a_i = col_map.get("answer", 3)
+    r_i = col_map.get("resource_link", 4)
+
     for row in ws.iter_rows(min_row=2, values_only=True):
-        question = str(row[col_map.get("question", 2)] or "").strip()
-        answer = str(row[col_map.get("answer", 3)] or "").strip()
+        q = row[q_i]
+        if not q:
+            continue
+        question = str(q).strip()
         if not question:
             continue
 
-        topic = str(row[col_map.get("topic", 0)] or "").strip()
-        location = str(row[col_map.get("location", 1)] or "").strip()
-        resource = str(row[col_map.get("resource_link", 4)] or "").strip()
+        a, t, l, r = row[a_i], row[t_i], row[l_i], row[r_i]
+        answer = str(a).strip() if a else ""
+        topic = str(t).strip() if t else ""
+        location = str(l).strip() if l else ""
+        resource = str(r).strip() if r else ""
 
         parts = []
         if topic:
@@ -238,37 +298,33 @@ def _split_large_chunk(
     if _approx_token_count(text) <= max_tokens:
         return [chunk]
 
-    sentences = re.split(r"(?<=[.!?])\s+", text)
-    sub_chunks: list[dict] = []
-    current_sentences: list[str] = []
-    current_tokens = 0
-
+    sentences = _SENTENCE_SPLIT_RE.split(text)
+    n = len(sentences)
     section_prefix = f"## {chunk['section']}\n" if chunk.get("section") else ""
 
-    for sent in sentences:
-        sent_tokens = _approx_token_count(sent)
-        if current_tokens + sent_tokens > max_tokens and current_sentences:
-            sub_text = section_prefix + " ".join(current_sentences)
-            sub_chunks.append({**chunk, "text": sub_text})
-
-            # Keep overlap
-            overlap_sents: list[str] = []
-            overlap_count = 0
-            for s in reversed(current_sentences):
-                t = _approx_token_count(s)
-                if overlap_count + t > overlap_tokens:
-                    break
-                overlap_sents.insert(0, s)
-                overlap_count += t
-            current_sentences = overlap_sents
-            current_tokens = overlap_count
-
-        current_sentences.append(sent)
-        current_tokens += sent_tokens
-
-    if current_sentences:
-        sub_text = section_prefix + " ".join(current_sentences)
+    # cum[i] = tokens in sentences[:i]; chunk boundaries are then found with
+    # binary searches instead of a per-sentence Python accumulator.
+    sent_tokens = np.fromiter(
+        (_approx_token_count(s) for s in sentences), dtype=np.int64, count=n
+    )
+    cum = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(sent_tokens, out=cum[1:])
+
+    sub_chunks: list[dict] = []
+    start = 0
+    min_end = 1  # a chunk always takes at least the sentence that opened it
+    while True:
+        end = int(np.searchsorted(cum, cum[start] + max_tokens, side="right")) - 1
+        end = max(end, min_end)
+        sub_text = section_prefix + " ".join(sentences[start:end])
         sub_chunks.append({**chunk, "text": sub_text})
+        if end >= n:
+            break
+
+        # Keep overlap: longest suffix of this chunk within overlap_tokens
+        overlap_start = int(np.searchsorted(cum, cum[end] - overlap_tokens, side="left"))
+        start = max(overlap_start, start)
+        min_end = end + 1
 
     return sub_chunks
 
@@ -291,46 +347,178 @@ def discover_documents(docs_dir: str = DOCUMENTS_DIR) -> tuple[list[str], list[s
     return docx_files, xlsx_files
 
 
+def _parse_now(parser, fpath: str) -> Future:
+    """Run `parser` inline, wrapped in a completed Future (the serial path)."""
+    fut: Future = Future()
+    try:
+        fut.set_result(parser(fpath))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+def _make_parse_pool(n_docx: int, n_files: int) -> Optional[ProcessPoolExecutor]:
+    """
+    Process pool for parsing, or None to parse serially.
+
+    Workers start from a forkserver: the Streamlit process already holds the
+    ONNX Runtime session and its threads, which must not be forked.  Where
+    forkserver is unavailable (Windows) parsing stays serial.
+    """
+    if n_docx < PARALLEL_PARSE_MIN_DOCX:
+        return None
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(
+        max_workers=min(n_files, 8, os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+
 def ingest_all(docs_dir: str = DOCUMENTS_DIR) -> tuple[list[dict], list[str]]:
-    """Parse and chunk every document.  Returns (chunks, filenames)."""
+    """
+    Parse and chunk every document.  Returns (chunks, filenames).
+
+    Larger corpora are parsed in worker processes; splitting of large SOP
+    sections stays on the main process since it is cheap.
+    """
     docx_files, xlsx_files = discover_documents(docs_dir)
     all_chunks: list[dict] = []
     all_filenames: list[str] = []
 
-    for fpath in docx_files:
-        logger.info(f"Parsing DOCX: {fpath}")
-        try:
-            sections = parse_docx(fpath)
-            for sec in sections:
-                all_chunks.extend(_split_large_chunk(sec))
-            all_filenames.append(os.path.basename(fpath))
-        except Exception as e:
-            logger.error(f"Failed to parse {fpath}: {e}", exc_info=True)
-
-    for fpath in xlsx_files:
-        logger.info(f"Parsing XLSX: {fpath}")
-        try:
-            faq_chunks = parse_xlsx(fpath)
-            all_chunks.extend(faq_chunks)
-            all_filenames.append(os.path.basename(fpath))
-        except Exception as e:
-            logger.error(f"Failed to parse {fpath}: {e}", exc_info=True)
+    if not docx_files and not xlsx_files:
+        logger.info("Ingestion complete: 0 chunks from 0 files")
+        return all_chunks, all_filenames
+
+    pool = _make_parse_pool(len(docx_files), len(docx_files) + len(xlsx_files))
+    submit = pool.submit if pool is not None else _parse_now
+    with pool or contextlib.nullcontext():
+        docx_futures = []
+        for fpath in docx_files:
+            logger.info(f"Parsing DOCX: {fpath}")
+            docx_futures.append((fpath, submit(parse_docx, fpath)))
+        xlsx_futures = []
+        for fpath in xlsx_files:
+            logger.info(f"Parsing XLSX: {fpath}")
+            xlsx_futures.append((fpath, submit(parse_xlsx, fpath)))
+
+        for fpath, fut in docx_futures:
+            try:
+                sections = fut.result()
+                for sec in sections:
+                    all_chunks.extend(_split_large_chunk(sec))
+                all_filenames.append(os.path.basename(fpath))
+            except Exception as e:
+                logger.error(f"Failed to parse {fpath}: {e}", exc_info=True)
+
+        for fpath, fut in xlsx_futures:
+            try:
+                faq_chunks = fut.result()
+                all_chunks.extend(faq_chunks)
+                all_filenames.append(os.path.basename(fpath))
+            except Exception as e:
+                logger.error(f"Failed to parse {fpath}: {e}", exc_info=True)
 
     logger.info(f"Ingestion complete: {len(all_chunks)} chunks from {len(all_filenames)} files")
     return all_chunks, all_filenames
 
 
+def index_cache_key(texts: list[str]) -> str:
+    """SHA256 over the chunk texts plus every setting that affects the stored vectors."""
+    h = hashlib.sha256()
+    settings = (
+        EMBEDDING_MODEL, EMBEDDING_ONNX_FILE, EMBEDDING_DIMENSION,
+        HNSW_MIN_VECTORS, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH,
+        "IndexFlatIP|IndexHNSWSQ-QT_8bit",  # bump if build_vector_store's index types change
+    )
+    h.update(repr(settings).encode())
+    for t in texts:
+        h.update(b"\0")
+        h.update(t.encode())
+    return h.hexdigest()
+
+
+def _prune_index_cache(cache_dir: str, keep: str) -> None:
+    """Delete cached indexes other than `keep` (they can never be hit again)."""
+    for f in Path(cache_dir).glob("*.faiss"):
+        if f.name != keep:
+            try:
+                f.unlink()
+            except OSError as e:
+                logger.warning(f"Failed to remove stale cached index {f}: {e}")
+
+
 def build_vector_store(
     chunks: list[dict],
     model: SentenceTransformer,
-) -> faiss.IndexFlatIP:
-    """Embed all chunks and return an in-memory FAISS index."""
+    cache_dir: str = INDEX_CACHE_DIR,
+) -> faiss.Index:
+    """
+    Embed all chunks and return an in-memory FAISS index aligned with `chunks`.
+
+    Small corpora use an exact IndexFlatIP; larger ones switch to HNSW
+    over int8 scalar-quantized vectors for O(log N) queries.  Both use
+    inner product on normalized vectors.
+
+    If an index for the same chunk texts and settings was already written
+    to `cache_dir`, it is loaded instead of re-embedding.
+    """
+    import faiss
+
+    # Process-wide, so this also covers index.search() in retriever.py
+    faiss.omp_set_num_threads(CPU_THREADS)
+
     texts = [c["text"] for c in chunks]
-    logger.info(f"Embedding {len(texts)} chunks …")
-    embeddings = model.encode(texts, show_progress_bar=False, normalize_embeddings=True)
-    embeddings = np.array(embeddings, dtype="float32")
+    index_name = f"{index_cache_key(texts)}.faiss"
+    index_path = os.path.join(cache_dir, index_name)
 
-    index = faiss.IndexFlatIP(EMBEDDING_DIMENSION)
-    index.add(embeddings)
+    if os.path.exists(index_path):
+        try:
+            index = faiss.read_index(index_path)
+            logger.info(f"Loaded cached FAISS index ({index.ntotal} vectors) from {index_path}")
+            return index
+        except Exception as e:
+            logger.warning(f"Failed to load cached index {index_path}, rebuilding: {e}")
+
+    logger.info(f"Embedding {len(texts)} chunks …")
+    # encode() already batches texts by length (and restores input order),
+    # so short FAQ rows aren't padded up to long SOP sections — no pre-sort.
+    embeddings = model.encode(
+        texts,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        show_progress_bar=False,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        precision="float32",
+    )
+    # No-op when the encoder already returned contiguous float32 (the usual case)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    if len(chunks) < HNSW_MIN_VECTORS:
+        index = faiss.IndexFlatIP(EMBEDDING_DIMENSION)
+        index.add(embeddings)
+    else:
+        # HNSW graph over 8-bit scalar-quantized vectors (4× smaller than float32)
+        index = faiss.IndexHNSWSQ(
+            EMBEDDING_DIMENSION,
+            faiss.ScalarQuantizer.QT_8bit,
+            HNSW_M,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.train(embeddings)
+        index.add(embeddings)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
     logger.info(f"FAISS index built with {index.ntotal} vectors")
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = index_path + ".tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, index_path)
+        _prune_index_cache(cache_dir, keep=index_name)
+        logger.info(f"Cached FAISS index to {index_path}")
+    except Exception as e:
+        logger.warning(f"Failed to cache index to {cache_dir}: {e}")
+
     return index
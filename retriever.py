@@ -4,10 +4,52 @@ MBP University — Retriever
 Similarity search over the FAISS index and context formatting for Claude.
 """
 
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-from config import TOP_K
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+from config import TOP_K, EMBEDDING_MODEL
+
+
+# Model used by _embed_query(), kept outside the LRU key so cached entries
+# don't hold old model objects alive.  Only the current model is kept.
+_query_models: dict[str, SentenceTransformer] = {}
+
+
+@lru_cache(maxsize=512)
+def _embed_query(query: str, model_id: str) -> bytes:
+    """
+    Embed a single query, cached so Streamlit reruns don't re-encode it.
+    `model_id` is part of the key so a model swap invalidates old entries.
+    """
+    query_vec = _query_models[model_id].encode(
+        [query], normalize_embeddings=True, convert_to_numpy=True
+    )
+    assert query_vec.dtype == np.float32
+    return query_vec.tobytes()
+
+
+def _use_query_model(model: SentenceTransformer, model_id: str) -> None:
+    """Register `model` for _embed_query(); a new object drops the old one and its cache."""
+    if _query_models.get(model_id) is not model:
+        _query_models.clear()
+        _query_models[model_id] = model
+        _embed_query.cache_clear()
+
+
+def _flat_vectors(index) -> np.ndarray | None:
+    """Zero-copy (ntotal, d) view of an IndexFlatIP's stored vectors, else None."""
+    import faiss
+
+    if not isinstance(index, faiss.IndexFlatIP):
+        return None
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
 
 
 def search(
@@ -21,11 +63,26 @@ def search(
     if index is None or not metadata:
         return []
 
-    query_vec = model.encode([query], normalize_embeddings=True).astype("float32")
-    scores, indices = index.search(query_vec, min(top_k, index.ntotal))
+    _use_query_model(model, EMBEDDING_MODEL)
+    query_vec = np.frombuffer(
+        _embed_query(query, EMBEDDING_MODEL), dtype="float32"
+    ).reshape(1, -1)
+    k = min(top_k, index.ntotal)
+
+    raw = _flat_vectors(index)
+    if raw is not None:
+        # Flat index (only built for small corpora): a single matmul beats
+        # FAISS's per-call dispatch
+        all_scores = (query_vec @ raw.T)[0]
+        top = np.argpartition(-all_scores, k - 1)[:k]
+        top = top[np.argsort(-all_scores[top])]
+        scores, indices = all_scores[top], top
+    else:
+        scores, indices = index.search(query_vec, k)
+        scores, indices = scores[0], indices[0]
 
     results = []
-    for score, idx in zip(scores[0], indices[0]):
+    for score, idx in zip(scores, indices):
         if idx < 0:
             continue
         chunk = metadata[idx].copy()
@@ -75,22 +132,24 @@ def format_sources_for_display(results: list[dict]) -> str:
     # Group: SOP sources by filename, FAQ sources separately
     sop_sources: dict[str, list[str]] = {}  # filename → list of section names
     faq_sources: list[dict] = []
-    seen_faq: set[str] = set()
+    seen: set[tuple] = set()  # ("faq", question) / ("sop", filename, section)
 
     for r in results:
-        if r.get("type") == "faq":
-            q = r.get("question", "")
-            if q in seen_faq:
+        kind = r.get("type")
+        if kind == "faq":
+            key = ("faq", r.get("question", ""))
+            if key in seen:
                 continue
-            seen_faq.add(q)
+            seen.add(key)
             faq_sources.append(r)
         else:
             fname = r.get("source", "Unknown")
             section = r.get("section", "N/A")
-            if fname not in sop_sources:
-                sop_sources[fname] = []
-            if section not in sop_sources[fname]:
-                sop_sources[fname].append(section)
+            key = ("sop", fname, section)
+            if key in seen:
+                continue
+            seen.add(key)
+            sop_sources.setdefault(fname, []).append(section)
 
     lines: list[str] = []
 